@@ -1,110 +1,432 @@
 # -*- coding: utf-8 -*-
 import os
+import re
+import atexit
 import random
 import logging
 import time
 import json
+import sqlite3
 import signal
 import sys
-from datetime import datetime
+import heapq
+import bisect
+import itertools
+import threading
+import unicodedata
+from array import array
+from collections import namedtuple
+from dataclasses import dataclass, field
+from functools import lru_cache
 from concurrent.futures import ThreadPoolExecutor
 
 import gspread
+import requests
 import telebot
-from oauth2client.service_account import ServiceAccountCredentials
+from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
+from telebot import apihelper
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+from urllib3.util.retry import Retry
+
+# orjson заметно быстрее стандартного json; если он не установлен, используем json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def loads_json(data):
+    """Разбирает JSON из bytes или str."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
 # Функция загрузки файла локализации
 def load_localization(filename="localization.json"):
     try:
-        with open(filename, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(filename, "rb") as f:
+            return loads_json(f.read())
     except Exception as e:
         logging.error(f"Ошибка загрузки файла локализации: {e}")
         return {}
 
 # Загружаем локализацию в глобальную переменную
 loc = load_localization()
+SETTINGS_TEMPLATE = loc["settings_message"]
+
+# Шаблоны и тексты сообщений, отправляемых на каждую викторину, привязываются один раз
+QUESTION_FORMATTERS = {
+    "reading": loc["reading_question"].format,
+    "meaning": loc["meaning_question"].format,
+    "reverse_reading": loc["reverse_reading_question"].format,
+    "reverse_meaning": loc["reverse_meaning_question"].format,
+}
+FORMAT_QUIZ_SENT = loc["quiz_sent"].format
+FORMAT_TIMEOUT = loc["timeout_message"].format
+FORMAT_CORRECT = loc["correct_answer_message"].format
+FORMAT_INCORRECT = loc["incorrect_answer_message"].format
+FORMAT_RECENTLY_SENT = loc["quiz_recently_sent"].format
+MSG_SHEET_NOT_SET = loc["sheet_not_set"]
+MSG_SHEET_EMPTY = loc["sheet_empty"]
+MSG_NO_ACTIVE_QUIZ = loc["no_active_quiz"]
+BTN_NEXT = loc["btn_next"]
 
 # Токен Telegram-бота (замените "TOKEN" на настоящий токен)
 TELEGRAM_BOT_TOKEN = "TOKEN"
-SETTINGS_FILE = "user_settings.json"
+BOT_NUM_THREADS = 10  # число потоков, параллельно обрабатывающих обновления Telegram
+POLLING_TIMEOUT = 30  # сколько секунд Telegram держит запрос getUpdates открытым в ожидании обновлений
+SETTINGS_DB = "user_settings.db"
+SETTINGS_FILE = "user_settings.json"  # старый формат настроек, импортируется в базу при первом запуске
+SETTINGS_SAVE_DELAY = 2.0  # задержка (в секундах), за которую изменения настроек объединяются в одну запись
+
+# Настройки вебхука. Если WEBHOOK_HOST пуст, бот работает через long polling.
+WEBHOOK_HOST = ""            # например, "https://example.com"
+WEBHOOK_SECRET = "SECRET"    # секрет для пути и заголовка X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_SSL_CERT = None      # путь к сертификату (None, если TLS терминируется прокси)
+WEBHOOK_SSL_PRIV = None      # путь к приватному ключу
+WEBHOOK_PATH = f"/webhook/{WEBHOOK_SECRET}"
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Словари для настроек пользователей (идентификатор пользователя – int)
-user_sheets = {}
-# user_intervals удалён
-user_preferences = {}
-user_quiet_intervals = {}
-user_timeouts = {}       # таймаут ответа (в минутах)
-user_states = {}         # текущее состояние (какую команду ввёл пользователь)
-user_quiz = {}           # текущая активная викторина
-user_timeouts_active = {}  # флаг активного отсчёта таймаута
-user_quiz_active = {}    # флаг автоотправки викторин
-user_next_quiz_sent = {} # флаг, показывающий, что следующий квиз уже отправлен
+SHEET_TTL = 600  # время жизни кэша записей Google таблицы (в секундах)
+# Интервальное повторение: когда викторина завершается, вес записи вдвое уменьшается, если ответ верный
+# с первой попытки, и вдвое растёт, если были ошибки или истёк таймаут (один раз за викторину);
+# вероятность выбора записи пропорциональна её весу
+WEIGHT_MIN = 0.125
+WEIGHT_MAX = 8.0
+# Лимиты отправки сообщений (token bucket): средняя скорость и сколько сообщений можно отправить подряд без ожидания
+SEND_RATE = 25  # не больше стольких сообщений в секунду на всех пользователей (лимит Telegram ~30)
+SEND_BURST = 5
+CHAT_SEND_INTERVAL = 1.0  # средний интервал (в секундах) между сообщениями в один чат
+CHAT_SEND_BURST = 3
+
+# Разделители вариантов ответа в ячейке таблицы
+ANSWER_SEPARATORS = re.compile(r"[,，/／、]")
+
+# Активная викторина: неизменяемый кортеж вместо словаря на каждый вопрос
+Quiz = namedtuple("Quiz", "kanji reading meaning type answers answers_text start_time")
+
+@dataclass
+class UserCtx:
+    """Настройки и текущее состояние одного пользователя."""
+    sheet: object = None          # лист Google таблицы (gspread.Worksheet), открывается при первой викторине
+    sheet_url: str = None         # URL таблицы
+    sheet_id: str = None          # ключ (ID) таблицы, по которому она открывается
+    mode: str = None              # режим викторины (None = по умолчанию, случайный)
+    quiet: tuple = None           # тихий режим: (начало, конец) в минутах от полуночи
+    timeout: int = None           # таймаут ответа (в минутах, None = не установлен)
+    state: str = None             # текущее состояние (какую команду ввёл пользователь)
+    quiz: Quiz = None             # текущая активная викторина
+    quiz_missed: bool = False     # в текущей викторине уже был неверный ответ
+    quiz_active: bool = True      # флаг автоотправки викторин
+    next_quiz_sent: bool = False  # флаг, показывающий, что следующий квиз уже отправлен
+    sending: bool = False         # викторина в процессе отправки
+    timeout_job: list = None      # запланированный таймаут текущей викторины
+    next_job: list = None         # запланированная автоотправка следующей викторины
+    records: list = None          # кэш записей таблицы: [(кандзи, чтение, значение), ...]
+    records_expires: float = 0.0  # момент истечения кэша записей
+    weights: dict = field(default_factory=dict, repr=False)  # вес записи для выбора: кандзи -> вес (по умолчанию 1)
+    cum_weights: array = None     # накопленные веса записей кэша (None = пересчитать при следующем выборе)
+    next_send_at: float = 0.0     # теоретический момент (time.monotonic()) следующей отправки в чат без превышения лимита
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+    # Отдельная блокировка для обращений к Google Sheets, чтобы не держать lock во время сетевых запросов
+    sheet_lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+# Состояние пользователей (идентификатор пользователя – int)
+users = {}
+users_lock = threading.Lock()
+
+def get_user(user_id):
+    """Возвращает состояние пользователя, создавая его при первом обращении."""
+    ctx = users.get(user_id)
+    if ctx is None:
+        with users_lock:
+            ctx = users.setdefault(user_id, UserCtx())
+    return ctx
 
 # Настройка API Google Sheets
 scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-creds = ServiceAccountCredentials.from_json_keyfile_name("credentials.json", scope)
+creds = Credentials.from_service_account_file("credentials.json", scopes=scope)
 client = gspread.authorize(creds)
 
+# Пул keep-alive соединений для Google API и повтор запросов при 429/5xx с экспоненциальной задержкой
+# (учитывается Retry-After). Адаптер монтируется в авторизованную сессию gspread, поэтому токен сохраняется.
+# После исчерпания попыток ответ возвращается gspread как есть и превращается в APIError.
+sheets_session = getattr(client, "http_client", client).session  # gspread 6.x / 5.x
+sheets_session.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=10,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+))
+
+# Общая HTTP-сессия для Telegram API: соединения переиспользуются (keep-alive) всеми потоками,
+# ответы 429 повторяются с учётом Retry-After. Повторяются только ошибки соединения (запрос не дошёл до сервера)
+# и 429; после таймаута чтения запрос не повторяется, иначе sendMessage мог бы доставить сообщение дважды.
+telegram_session = requests.Session()
+telegram_session.mount("https://", HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=50,
+    max_retries=Retry(
+        total=3,
+        connect=3,
+        read=0,
+        status=3,
+        backoff_factor=0.3,
+        status_forcelist=[429],
+        allowed_methods=None
+    )
+))
+apihelper.session = telegram_session
+
 # Настройка Telegram-бота
-bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN)
+bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN, num_threads=BOT_NUM_THREADS)
 
 # Thread pool для управления потоками
 executor = ThreadPoolExecutor(max_workers=10)
 
-def save_user_settings():
-    """Сохранить настройки пользователей в JSON-файл."""
-    settings = {
-        "preferences": {str(k): v for k, v in user_preferences.items()},
-        "timeouts": {str(k): v for k, v in user_timeouts.items()},
-        "quiet_intervals": {
-            str(k): (v[0].strftime("%H:%M"), v[1].strftime("%H:%M")) for k, v in user_quiet_intervals.items()
-        },
-        "sheets": {str(k): v.spreadsheet.url for k, v in user_sheets.items() if v},
-        "auto_quiz_active": {str(k): user_quiz_active.get(k, True) for k in user_preferences.keys()},
-        "quiz_schedule_status": {str(k): "Active" if user_quiz_active.get(k, True) else "Stopped" for k in user_preferences.keys()}
-    }
-    with open(SETTINGS_FILE, "w", encoding="utf-8") as f:
-        json.dump(settings, f, indent=4)
-    logging.info("Настройки пользователя сохранены.")
+# База настроек пользователей; запись сериализуется через settings_write_lock
+settings_db = sqlite3.connect(SETTINGS_DB, check_same_thread=False)
+settings_db.execute("PRAGMA journal_mode=WAL")
+
+# Пользователи с несохранёнными изменениями настроек
+settings_dirty = threading.Event()
+settings_dirty_users = set()
+settings_dirty_lock = threading.Lock()
+settings_write_lock = threading.Lock()
+
+# Теоретический момент (time.monotonic()) следующей отправки без превышения общего лимита
+send_next_at = 0.0
+send_rate_lock = threading.Lock()
+
+# Очередь отложенных задач: [момент запуска, порядковый номер, функция, аргументы]
+scheduler_heap = []
+scheduler_cv = threading.Condition()
+scheduler_seq = itertools.count()
+
+def parse_hhmm(text):
+    """Разбирает время в формате ЧЧ:ММ в минуты от полуночи (ValueError при неверном формате)."""
+    # Разбираем вручную: strptime заметно медленнее из-за разбора строки формата
+    hours, sep, minutes = text.partition(":")
+    if (not sep or not 1 <= len(hours) <= 2 or not 1 <= len(minutes) <= 2
+            or not hours.isdecimal() or not minutes.isdecimal()):
+        raise ValueError(f"Неверный формат времени: {text!r}")
+    hours, minutes = int(hours), int(minutes)
+    if hours > 23 or minutes > 59:
+        raise ValueError(f"Неверное время: {text!r}")
+    return hours * 60 + minutes
+
+def format_hhmm(minutes):
+    """Форматирует минуты от полуночи как ЧЧ:ММ."""
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+def save_user_settings(user_id):
+    """Отмечает настройки пользователя как изменённые; запись в базу выполнит фоновый поток."""
+    with settings_dirty_lock:
+        settings_dirty_users.add(user_id)
+    settings_dirty.set()
+
+def settings_flusher():
+    """Фоновый поток: объединяет изменения за SETTINGS_SAVE_DELAY секунд в одну транзакцию."""
+    while True:
+        settings_dirty.wait()
+        time.sleep(SETTINGS_SAVE_DELAY)
+        settings_dirty.clear()
+        try:
+            flush_user_settings()
+        except Exception as e:
+            logging.error(f"Ошибка сохранения настроек: {e}")
+
+def flush_user_settings():
+    """Записывает в базу настройки всех пользователей, изменённых с момента прошлой записи."""
+    global settings_dirty_users
+    with settings_dirty_lock:
+        user_ids, settings_dirty_users = settings_dirty_users, set()
+    if user_ids:
+        write_user_settings(user_ids)
+
+def write_user_settings(user_ids):
+    """Сохранить настройки указанных пользователей в SQLite (по одной строке на пользователя)."""
+    rows = []
+    for uid in user_ids:
+        ctx = get_user(uid)
+        quiet_start, quiet_end = (format_hhmm(q) for q in ctx.quiet) if ctx.quiet else (None, None)
+        rows.append((uid, ctx.mode, ctx.timeout, quiet_start, quiet_end, ctx.sheet_url, ctx.sheet_id, int(ctx.quiz_active)))
+    with settings_write_lock, settings_db:
+        settings_db.executemany(
+            "INSERT OR REPLACE INTO users (uid, mode, timeout, quiet_start, quiet_end, sheet_url, sheet_id, quiz_active) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+    logging.info(f"Настройки сохранены для {len(rows)} пользователей.")
 
 def load_user_settings():
-    """Загрузить настройки пользователей из JSON-файла."""
-    global user_preferences, user_timeouts, user_quiet_intervals, user_sheets, user_quiz_active
+    """Загрузить настройки пользователей из SQLite (при первом запуске — импортировать из JSON-файла)."""
+    with settings_write_lock, settings_db:
+        settings_db.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "uid INTEGER PRIMARY KEY, mode TEXT, timeout INTEGER, quiet_start TEXT, quiet_end TEXT, "
+            "sheet_url TEXT, sheet_id TEXT, quiz_active INTEGER NOT NULL DEFAULT 1)"
+        )
+        rows = settings_db.execute(
+            "SELECT uid, mode, timeout, quiet_start, quiet_end, sheet_url, sheet_id, quiz_active FROM users"
+        ).fetchall()
+    if not rows:
+        import_json_settings()
+        return
+    # Таблицы не открываем: это произойдёт при первой викторине пользователя
+    for uid, mode, timeout, quiet_start, quiet_end, sheet_url, sheet_id, quiz_active in rows:
+        ctx = get_user(uid)
+        ctx.mode = mode
+        ctx.timeout = timeout
+        if quiet_start and quiet_end:
+            ctx.quiet = (parse_hhmm(quiet_start), parse_hhmm(quiet_end))
+        ctx.sheet_url = sheet_url
+        ctx.sheet_id = sheet_id
+        ctx.quiz_active = bool(quiz_active)
+    logging.info(f"Настройки пользователей загружены: {len(rows)}.")
+
+def import_json_settings():
+    """Однократный перенос настроек из старого JSON-файла в базу."""
     if not os.path.exists(SETTINGS_FILE) or os.stat(SETTINGS_FILE).st_size == 0:
-        logging.warning("Файл настроек не найден или пуст. Создаю новый файл.")
-        save_user_settings()
+        logging.warning("Настройки пользователей не найдены. Начинаю с пустой базы.")
         return
     try:
-        with open(SETTINGS_FILE, "r", encoding="utf-8") as f:
-            settings = json.load(f)
-        user_preferences = {int(k): v for k, v in settings.get("preferences", {}).items()}
-        user_timeouts = {int(k): v for k, v in settings.get("timeouts", {}).items()}
-        user_quiet_intervals = {
-            int(k): (datetime.strptime(v[0], "%H:%M").time(), datetime.strptime(v[1], "%H:%M").time())
-            for k, v in settings.get("quiet_intervals", {}).items()
-        }
-        sheets_from_file = settings.get("sheets", {})
-        user_sheets_temp = {}
-        for uid, sheet_url in sheets_from_file.items():
-            try:
-                user_sheets_temp[int(uid)] = client.open_by_url(sheet_url).sheet1
-            except Exception as e:
-                logging.error(f"Не удалось переподключиться к Google таблице для пользователя {uid}: {e}")
-                user_sheets_temp[int(uid)] = None
-        user_sheets = user_sheets_temp
+        with open(SETTINGS_FILE, "rb") as f:
+            settings = loads_json(f.read())
+        for uid, mode in settings.get("preferences", {}).items():
+            get_user(int(uid)).mode = mode
+        for uid, timeout in settings.get("timeouts", {}).items():
+            get_user(int(uid)).timeout = timeout
+        for uid, v in settings.get("quiet_intervals", {}).items():
+            get_user(int(uid)).quiet = (parse_hhmm(v[0]), parse_hhmm(v[1]))
+        for uid, sheet_info in settings.get("sheets", {}).items():
+            ctx = get_user(int(uid))
+            if isinstance(sheet_info, str):
+                # Старый формат: только URL
+                ctx.sheet_url = sheet_info
+                try:
+                    ctx.sheet_id = gspread.utils.extract_id_from_url(sheet_info)
+                except gspread.exceptions.NoValidUrlKeyFound:
+                    logging.error(f"Некорректный URL Google таблицы у пользователя {uid}: {sheet_info}")
+            else:
+                ctx.sheet_url = sheet_info.get("url")
+                ctx.sheet_id = sheet_info.get("id")
         # Загружаем автоотправку викторин (если присутствует)
-        auto_status = settings.get("auto_quiz_active", {})
-        for uid_str, status in auto_status.items():
-            user_quiz_active[int(uid_str)] = status
-        logging.info("Настройки пользователя успешно загружены.")
+        for uid, status in settings.get("auto_quiz_active", {}).items():
+            get_user(int(uid)).quiz_active = status
     except (json.JSONDecodeError, ValueError):
-        logging.error("Файл настроек повреждён. Сбрасываю настройки.")
-        save_user_settings()
+        logging.error(f"Файл настроек {SETTINGS_FILE} повреждён. Начинаю с пустой базы.")
+        return
+    write_user_settings(list(users))
+    logging.info(f"Настройки перенесены из {SETTINGS_FILE} в {SETTINGS_DB}.")
+
+def open_sheet(sheet_id):
+    """Открывает первый лист таблицы по ключу (повторы при 429/5xx выполняет адаптер sheets_session)."""
+    return client.open_by_key(sheet_id).sheet1
+
+def get_sheet(ctx):
+    """Возвращает лист таблицы пользователя, открывая его при первом обращении."""
+    if ctx.sheet is None:
+        with ctx.sheet_lock:
+            if ctx.sheet is None:
+                ctx.sheet = open_sheet(ctx.sheet_id)
+    return ctx.sheet
+
+def read_sheet_rows(sheet):
+    """
+    Читает значения листа одним запросом и возвращает [(кандзи, чтение, значение), ...].
+    Столбцы находятся по заголовкам Kanji/Reading/Meaning в первой строке; строки без кандзи пропускаются.
+    """
+    values = sheet.get_values()
+    if not values:
+        return []
+    header = values[0]
+    kanji_col, reading_col, meaning_col = header.index("Kanji"), header.index("Reading"), header.index("Meaning")
+    last_col = max(kanji_col, reading_col, meaning_col)
+    return [
+        (row[kanji_col], row[reading_col], row[meaning_col])
+        for row in values[1:]
+        if len(row) > last_col and row[kanji_col]
+    ]
+
+def get_sheet_records(ctx):
+    """
+    Возвращает записи таблицы пользователя в виде кортежей (кандзи, чтение, значение),
+    обращаясь к Google Sheets только при промахе кэша.
+    """
+    if ctx.records is None or time.time() >= ctx.records_expires:
+        # Только один поток обновляет кэш; остальные дожидаются и берут готовый результат
+        with ctx.sheet_lock:
+            if ctx.records is None or time.time() >= ctx.records_expires:
+                records = read_sheet_rows(ctx.sheet)
+                ctx.records = records
+                ctx.cum_weights = None
+                # Небольшой разброс TTL, чтобы кэши разных пользователей не истекали одновременно
+                ctx.records_expires = time.time() + SHEET_TTL * random.uniform(0.9, 1.1)
+                logging.debug(f"Кэш таблицы обновлён: {len(records)} записей.")
+                return records
+    logging.debug("Записи таблицы взяты из кэша.")
+    return ctx.records
+
+def next_record(ctx, records):
+    """
+    Выбирает запись с вероятностью, пропорциональной её весу (хуже выученные выпадают чаще).
+    Накопленные веса пересчитываются только после изменения весов или обновления кэша;
+    сам выбор — двоичный поиск.
+    """
+    with ctx.lock:
+        cum = ctx.cum_weights
+        if cum is None or len(cum) != len(records):
+            weights = ctx.weights
+            cum = ctx.cum_weights = array("d", itertools.accumulate(weights.get(r[0], 1.0) for r in records))
+        i = bisect.bisect(cum, random.random() * cum[-1])
+    return records[min(i, len(records) - 1)]
+
+def adjust_weight(ctx, kanji, factor):
+    """Умножает вес записи на factor в пределах [WEIGHT_MIN, WEIGHT_MAX]; вызывается под ctx.lock."""
+    weight = ctx.weights.get(kanji, 1.0) * factor
+    ctx.weights[kanji] = min(max(weight, WEIGHT_MIN), WEIGHT_MAX)
+    ctx.cum_weights = None
+
+def send_message(chat_id, text, **kwargs):
+    """
+    Отправляет сообщение, соблюдая лимиты Telegram: общий (SEND_RATE в секунду) и для одного чата.
+    Лимиты — token bucket (GCRA): короткая серия до SEND_BURST / CHAT_SEND_BURST сообщений уходит сразу,
+    дальше каждое сообщение резервирует ближайший свободный момент.
+    Если ждать нужно, сообщение ставится в очередь задач, а не блокирует поток обработчика.
+    Ответы 429, если они всё же придут, повторяет telegram_session с учётом Retry-After.
+    """
+    global send_next_at
+    ctx = get_user(chat_id)
+    with send_rate_lock:
+        now = time.monotonic()
+        slot = max(
+            now,
+            send_next_at - (SEND_BURST - 1) / SEND_RATE,
+            ctx.next_send_at - (CHAT_SEND_BURST - 1) * CHAT_SEND_INTERVAL
+        )
+        send_next_at = max(send_next_at, slot) + 1 / SEND_RATE
+        ctx.next_send_at = max(ctx.next_send_at, slot) + CHAT_SEND_INTERVAL
+    if slot > now:
+        schedule(slot - now, deliver_message, chat_id, text, kwargs)
+        return None
+    return bot.send_message(chat_id, text, **kwargs)
+
+def deliver_message(chat_id, text, kwargs):
+    """Отправляет отложенное сообщение из очереди задач (ошибки executor иначе потерял бы молча)."""
+    try:
+        bot.send_message(chat_id, text, **kwargs)
+    except Exception as e:
+        logging.error(f"Не удалось отправить сообщение пользователю {chat_id}: {e}")
 
 def get_commands_keyboard():
     """Генерирует inline-клавиатуру с командами бота."""
@@ -123,112 +445,145 @@ def get_commands_keyboard():
         keyboard.add(InlineKeyboardButton(text, callback_data=callback_data))
     return keyboard
 
+def get_mode_keyboard():
+    """Генерирует inline-клавиатуру выбора режима викторины, включая реверс-режимы."""
+    keyboard = InlineKeyboardMarkup(row_width=3)
+    modes = [
+        (loc["mode_reading"], "mode_reading"),
+        (loc["mode_meaning"], "mode_meaning"),
+        (loc["mode_random"], "mode_random"),
+        (loc["mode_reverse_reading"], "mode_reverse_reading"),
+        (loc["mode_reverse_meaning"], "mode_reverse_meaning")
+    ]
+    buttons = [InlineKeyboardButton(text, callback_data=callback_data) for text, callback_data in modes]
+    keyboard.add(*buttons)
+    return keyboard
+
+# Клавиатуры статичны, поэтому создаются один раз при запуске
+COMMANDS_KEYBOARD = get_commands_keyboard()
+MODE_KEYBOARD = get_mode_keyboard()
+NEXT_KEYBOARD = InlineKeyboardMarkup()
+NEXT_KEYBOARD.add(InlineKeyboardButton(BTN_NEXT, callback_data="next_question"))
+
 @bot.message_handler(commands=["start"])
 def send_welcome(message):
     """Приветственное сообщение с опциями команд."""
-    bot.send_message(
+    send_message(
         message.chat.id,
         loc["welcome_message"],
-        reply_markup=get_commands_keyboard()
+        reply_markup=COMMANDS_KEYBOARD
     )
 
 @bot.message_handler(commands=["help"])
 def send_help(message):
     """Отправка справочного сообщения."""
-    bot.send_message(message.chat.id, loc["help_message"], reply_markup=get_commands_keyboard())
+    send_message(message.chat.id, loc["help_message"], reply_markup=COMMANDS_KEYBOARD)
+
+@bot.message_handler(commands=["refresh"])
+def refresh_sheet(message):
+    """Сбрасывает кэш записей таблицы, чтобы изменения в ней подхватились без ожидания SHEET_TTL."""
+    user_id = message.chat.id
+    get_user(user_id).records = None
+    send_message(user_id, loc["sheet_refreshed"])
 
 # Отладочная команда: вывод UID пользователя
 @bot.message_handler(commands=["uid"])
 def send_uid(message):
-    bot.send_message(message.chat.id, f"Ваш UID: {message.chat.id}")
+    send_message(message.chat.id, f"Ваш UID: {message.chat.id}")
 
-@bot.callback_query_handler(func=lambda call: True)
-def handle_command_click(call):
-    """Обработка нажатий кнопок inline-клавиатуры."""
+@bot.callback_query_handler(func=lambda call: call.data.startswith("mode_"))
+def handle_mode_selection(call):
+    """Обработка выбора режима викторины."""
+    bot.answer_callback_query(call.id)
     user_id = call.message.chat.id
-    if call.data == "setup":
-        bot.send_message(user_id, loc["setup_prompt"])
-        user_states[user_id] = "setup"
-    elif call.data == "setmode":
-        show_mode_selection(user_id)
-        bot.answer_callback_query(call.id)
-    elif call.data == "setquietinterval":
-        bot.send_message(user_id, loc["setquietinterval_prompt"])
-        user_states[user_id] = "setquietinterval"
-    elif call.data == "settimeout":
-        bot.send_message(user_id, loc["settimeout_prompt"])
-        user_states[user_id] = "settimeout"
-    elif call.data == "quiz":
-        user_quiz_active[user_id] = True
+    mode = call.data.replace("mode_", "")
+    get_user(user_id).mode = mode
+    send_message(user_id, loc["mode_set"].format(mode=mode), parse_mode="Markdown")
+    save_user_settings(user_id)
+
+def prompt_input(user_id, ctx, command):
+    """Запрашивает у пользователя ввод для команды и запоминает, какой ввод ожидается."""
+    send_message(user_id, loc[f"{command}_prompt"])
+    ctx.state = command
+
+def on_quiz_click(user_id, ctx):
+    """Кнопка «Начать викторину»: включает автоотправку и отправляет вопрос."""
+    ctx.quiz_active = True
+    save_user_settings(user_id)
+    send_quiz_auto(user_id)
+
+def on_stopquiz_click(user_id, ctx):
+    """Кнопка «Остановить викторину»."""
+    with ctx.lock:
+        quiz, ctx.quiz = ctx.quiz, None
+        cancel_job(ctx.timeout_job)
+    if quiz:
+        send_message(user_id, loc["stopquiz_success"])
+    else:
+        send_message(user_id, loc["stopquiz_not_found"])
+
+def on_next_question_click(user_id, ctx):
+    """Кнопка «Следующий» после правильного ответа."""
+    if claim_next_quiz(ctx):
+        cancel_job(ctx.next_job)
         send_quiz_auto(user_id)
-    elif call.data == "stopquiz":
-        # Останавливаем текущую викторину
-        if user_id in user_quiz:
-            del user_quiz[user_id]
-            bot.send_message(user_id, loc["stopquiz_success"])
-        else:
-            bot.send_message(user_id, loc["stopquiz_not_found"])
-    elif call.data == "stopquizauto":
-        if user_quiz_active.get(user_id, True):
-            user_quiz_active[user_id] = False
-            bot.send_message(user_id, loc["stopquizauto_success"])
-            logging.info(f"Автоотправка викторин отключена для {user_id}.")
-        else:
-            bot.send_message(user_id, loc["stopquizauto_already"])
-        bot.answer_callback_query(call.id)
-    elif call.data == "settings":
-        show_user_settings_inline(user_id)
-    elif call.data == "next_question":
-        if not user_next_quiz_sent.get(user_id, False):
-            user_next_quiz_sent[user_id] = True
-            send_quiz_auto(user_id)
-        bot.answer_callback_query(call.id)
-    elif call.data.startswith("mode_"):
-        mode = call.data.replace("mode_", "")
-        user_preferences[user_id] = mode
-        bot.send_message(user_id, loc["mode_set"].format(mode=mode), parse_mode="Markdown")
-        save_user_settings()
-        bot.answer_callback_query(call.id)
-
-@bot.message_handler(func=lambda message: message.chat.id in user_states)
-def handle_user_input(message):
-    """Обработка пользовательского ввода после выбора команды."""
-    user_id = message.chat.id
-    command = user_states[user_id]
-    del user_states[user_id]
-    if command == "setup":
-        handle_setup_command(user_id, message)
-    elif command == "settimeout":
-        handle_set_timeout_command(user_id, message)
-    elif command == "setquietinterval":
-        handle_set_quiet_interval_command(user_id, message)
+
+# Обработчики нажатий кнопок: callback_data -> функция(user_id, ctx)
+CALLBACK_HANDLERS = {
+    "setup": lambda user_id, ctx: prompt_input(user_id, ctx, "setup"),
+    "setmode": lambda user_id, ctx: show_mode_selection(user_id),
+    "setquietinterval": lambda user_id, ctx: prompt_input(user_id, ctx, "setquietinterval"),
+    "settimeout": lambda user_id, ctx: prompt_input(user_id, ctx, "settimeout"),
+    "quiz": on_quiz_click,
+    "stopquiz": on_stopquiz_click,
+    "stopquizauto": lambda user_id, ctx: stop_quiz_auto_for(user_id),
+    "settings": lambda user_id, ctx: show_user_settings_inline(user_id),
+    "next_question": on_next_question_click,
+}
+
+@bot.callback_query_handler(func=lambda call: not call.data.startswith("mode_"))
+def handle_command_click(call):
+    """Обработка нажатий кнопок inline-клавиатуры."""
+    # Отвечаем на нажатие сразу, чтобы индикатор загрузки на кнопке не ждал отправки викторины
+    bot.answer_callback_query(call.id)
+    handler = CALLBACK_HANDLERS.get(call.data)
+    if handler is not None:
+        user_id = call.message.chat.id
+        handler(user_id, get_user(user_id))
 
 def handle_setup_command(user_id, message):
     """Обработка команды настройки Google таблицы."""
     sheet_url = message.text.strip()
     try:
         sheet = client.open_by_url(sheet_url).sheet1
-        user_sheets[user_id] = sheet
-        save_user_settings()
-        bot.send_message(user_id, loc["google_sheet_setup_success"])
+        ctx = get_user(user_id)
+        ctx.sheet = sheet
+        ctx.sheet_url = sheet_url
+        ctx.sheet_id = sheet.spreadsheet.id
+        ctx.records = None
+        save_user_settings(user_id)
+        send_message(user_id, loc["google_sheet_setup_success"])
     except gspread.exceptions.SpreadsheetNotFound:
-        bot.send_message(user_id, loc["google_sheet_setup_error"])
+        send_message(user_id, loc["google_sheet_setup_error"])
     except Exception as e:
-        bot.send_message(user_id, loc["google_sheet_setup_exception"].format(error=str(e)))
+        send_message(user_id, loc["google_sheet_setup_exception"].format(error=str(e)))
 
 def handle_set_timeout_command(user_id, message):
     """Обработка команды установки таймаута ответа."""
-    if message.text.isdigit():
-        timeout = int(message.text)
-        if not (0 <= timeout <= 1440):
-            bot.send_message(user_id, loc["settimeout_invalid"])
-            return
-        user_timeouts[user_id] = timeout
-        save_user_settings()
-        logging.info(f"Пользователь {user_id} установил таймаут ответа: {timeout} минут.")
-        bot.send_message(user_id, loc["settimeout_success"].format(timeout=timeout), parse_mode="Markdown")
-    else:
-        bot.send_message(user_id, loc["settimeout_invalid_input"])
+    text = message.text.strip()
+    if not text.isdecimal():
+        send_message(user_id, loc["settimeout_invalid_input"])
+        return
+    # Больше четырёх значащих цифр заведомо выходит за 1440, такие строки не разбираем
+    digits = text.lstrip("0") or "0"
+    timeout = int(digits) if len(digits) <= 4 else None
+    if timeout is None or timeout > 1440:
+        send_message(user_id, loc["settimeout_invalid"])
+        return
+    get_user(user_id).timeout = timeout
+    save_user_settings(user_id)
+    logging.info(f"Пользователь {user_id} установил таймаут ответа: {timeout} минут.")
+    send_message(user_id, loc["settimeout_success"].format(timeout=timeout), parse_mode="Markdown")
 
 def handle_set_quiet_interval_command(user_id, message):
     """Обработка команды установки тихого режима."""
@@ -236,117 +591,237 @@ def handle_set_quiet_interval_command(user_id, message):
         quiet_times = message.text.strip().split("-")
         if len(quiet_times) != 2:
             raise ValueError("Неверный формат")
-        quiet_start = datetime.strptime(quiet_times[0], "%H:%M").time()
-        quiet_end = datetime.strptime(quiet_times[1], "%H:%M").time()
-        user_quiet_intervals[user_id] = (quiet_start, quiet_end)
-        save_user_settings()
-        logging.info(f"Пользователь {user_id} установил тихий режим: {quiet_start.strftime('%H:%M')} - {quiet_end.strftime('%H:%M')}.")
-        bot.send_message(user_id, loc["setquietinterval_success"].format(
-            start=quiet_start.strftime("%H:%M"),
-            end=quiet_end.strftime("%H:%M")
+        quiet_start = parse_hhmm(quiet_times[0])
+        quiet_end = parse_hhmm(quiet_times[1])
+        get_user(user_id).quiet = (quiet_start, quiet_end)
+        save_user_settings(user_id)
+        logging.info(f"Пользователь {user_id} установил тихий режим: {format_hhmm(quiet_start)} - {format_hhmm(quiet_end)}.")
+        send_message(user_id, loc["setquietinterval_success"].format(
+            start=format_hhmm(quiet_start),
+            end=format_hhmm(quiet_end)
         ))
     except ValueError:
-        bot.send_message(user_id, loc["setquietinterval_invalid"])
+        send_message(user_id, loc["setquietinterval_invalid"])
 
 def show_user_settings_inline(user_id):
     """Показывает текущие настройки пользователя, включая статус автоотправки и статус викторины."""
-    mode = user_preferences.get(user_id, "По умолчанию (случайный)")
-    timeout = user_timeouts.get(user_id, None)
-    quiet = user_quiet_intervals.get(user_id, None)
+    ctx = get_user(user_id)
+    settings_text = render_settings(ctx.mode, ctx.timeout, ctx.quiet, ctx.quiz_active, ctx.quiz is not None)
+    send_message(user_id, settings_text, parse_mode="Markdown")
+
+@lru_cache(maxsize=1024)
+def render_settings(mode, timeout, quiet, quiz_active, has_quiz):
+    """Формирует текст настроек; результат кэшируется, так как набор комбинаций настроек невелик."""
     timeout_text = f"{timeout} минут" if timeout is not None else "Не установлено"
-    quiet_text = f"{quiet[0].strftime('%H:%M')} - {quiet[1].strftime('%H:%M')}" if quiet else "Не установлено"
-    auto_quiz_status = "Включена" if user_quiz_active.get(user_id, True) else "Отключена"
-    quiz_schedule_status = "Активна" if user_quiz.get(user_id) else "Не активна"
-    settings_text = loc["settings_message"].format(
-        mode=mode,
+    quiet_text = f"{format_hhmm(quiet[0])} - {format_hhmm(quiet[1])}" if quiet else "Не установлено"
+    return SETTINGS_TEMPLATE.format(
+        mode=mode or "По умолчанию (случайный)",
         timeout=timeout_text,
         quiet=quiet_text,
-        auto_quiz=auto_quiz_status,
-        schedule=quiz_schedule_status
+        auto_quiz="Включена" if quiz_active else "Отключена",
+        schedule="Активна" if has_quiz else "Не активна"
     )
-    bot.send_message(user_id, settings_text, parse_mode="Markdown")
 
 def send_quiz_auto(user_id):
-    """Отправка викторины пользователю (автоотправка по команде /quiz)."""
-    if user_id not in user_sheets:
-        bot.send_message(user_id, loc["sheet_not_set"])
+    """
+    Отправка викторины пользователю (автоотправка по команде /quiz).
+    Одновременные вызовы для одного пользователя (кнопка, таймаут, расписание) не дублируют вопрос.
+    """
+    ctx = get_user(user_id)
+    with ctx.lock:
+        if ctx.sending:
+            logging.info(FORMAT_RECENTLY_SENT(user=user_id))
+            return
+        ctx.sending = True
+    try:
+        send_quiz(ctx, user_id)
+    finally:
+        ctx.sending = False
+
+def normalize_answer(text):
+    """
+    Приводит ответ к виду для сравнения: NFKC (полуширинная катакана и полноширинная латиница
+    становятся обычными) и casefold вместо lower.
+    """
+    return unicodedata.normalize("NFKC", text).casefold()
+
+def send_quiz(ctx, user_id):
+    """Выбирает запись из таблицы, создаёт викторину и отправляет вопрос."""
+    if ctx.sheet_id is None:
+        send_message(user_id, MSG_SHEET_NOT_SET)
         return
-    sheet = user_sheets[user_id]
-    data = sheet.get_all_records()
+    try:
+        get_sheet(ctx)
+    except Exception as e:
+        logging.error(f"Не удалось открыть Google таблицу для пользователя {user_id}: {e}")
+        send_message(user_id, loc["google_sheet_setup_exception"].format(error=str(e)))
+        return
+    data = get_sheet_records(ctx)
     if not data:
-        bot.send_message(user_id, loc["sheet_empty"])
+        send_message(user_id, MSG_SHEET_EMPTY)
         return
-    # Выбираем случайную запись
-    kanji_entry = random.choice(data)
+    # Выбираем запись с учётом весов интервального повторения
+    kanji, reading, meaning = next_record(ctx, data)
     # Определяем тип вопроса в зависимости от выбранного режима
-    question_type = user_preferences.get(user_id, "random")
+    question_type = ctx.mode or "random"
     if question_type == "random":
         question_type = random.choice(["reading", "meaning", "reverse_reading", "reverse_meaning"])
+    # Правильные ответы вычисляем (и нормализуем) один раз при создании викторины
+    if question_type in ["reverse_reading", "reverse_meaning"]:
+        correct_answers = [kanji.strip()]
+    else:
+        answer_cell = reading if question_type == "reading" else meaning
+        correct_answers = [ans.strip() for ans in ANSWER_SEPARATORS.split(answer_cell) if ans.strip()]
     # Сохраняем данные викторины
-    user_quiz[user_id] = {
-        "kanji": kanji_entry["Kanji"],
-        "reading": kanji_entry["Reading"],
-        "meaning": kanji_entry["Meaning"],
-        "type": question_type,
-        "start_time": time.time()
-    }
-    if question_type == "reading":
-        bot.send_message(user_id, loc["reading_question"].format(kanji=kanji_entry["Kanji"]))
-    elif question_type == "meaning":
-        bot.send_message(user_id, loc["meaning_question"].format(kanji=kanji_entry["Kanji"]))
-    elif question_type == "reverse_reading":
-        bot.send_message(user_id, loc["reverse_reading_question"].format(reading=kanji_entry["Reading"]))
-    elif question_type == "reverse_meaning":
-        bot.send_message(user_id, loc["reverse_meaning_question"].format(meaning=kanji_entry["Meaning"]))
-    logging.info(loc["quiz_sent"].format(user=user_id, kanji=kanji_entry["Kanji"], type=question_type))
+    quiz = Quiz(
+        kanji=kanji,
+        reading=reading,
+        meaning=meaning,
+        type=question_type,
+        answers=frozenset(normalize_answer(ans) for ans in correct_answers),
+        answers_text=", ".join(correct_answers),
+        start_time=time.time()
+    )
+    with ctx.lock:
+        ctx.quiz = quiz
+        ctx.quiz_missed = False
+        # Новый вопрос заменяет ожидавшую автоотправку и кнопку «Следующий» предыдущего ответа
+        ctx.next_quiz_sent = True
+        cancel_job(ctx.next_job)
+        ctx.next_job = None
+    send_message(user_id, QUESTION_FORMATTERS[question_type](kanji=kanji, reading=reading, meaning=meaning))
+    logging.info(FORMAT_QUIZ_SENT(user=user_id, kanji=kanji, type=question_type))
     # Если установлен таймаут (> 0), запускаем проверку
-    timeout_value = user_timeouts.get(user_id, 1)
+    timeout_value = get_timeout(ctx)
     if timeout_value > 0:
-        timeout_seconds = timeout_value * 60
-        if not user_timeouts_active.get(user_id, False):
-            user_timeouts_active[user_id] = True
-            executor.submit(handle_timeout_check, user_id, timeout_seconds)
+        cancel_job(ctx.timeout_job)
+        ctx.timeout_job = schedule_at(quiz.start_time + timeout_value * 60, handle_timeout, user_id, quiz.start_time)
     else:
         logging.info(f"Таймаут ответа равен 0 для {user_id}: проверка таймаута не запущена.")
 
-def handle_timeout_check(user_id, timeout):
-    """Проверяет, ответил ли пользователь до истечения времени таймаута."""
-    for _ in range(timeout):
-        time.sleep(1)
-        if user_id not in user_quiz:
+def schedule_at(when, func, *args):
+    """Ставит вызов func(*args) в общую очередь на момент when (time.time()); возвращает задачу для cancel_job."""
+    job = [when, next(scheduler_seq), func, args]
+    with scheduler_cv:
+        heapq.heappush(scheduler_heap, job)
+        scheduler_cv.notify()
+    return job
+
+def schedule(delay, func, *args):
+    """Ставит вызов func(*args) в общую очередь через delay секунд."""
+    return schedule_at(time.time() + delay, func, *args)
+
+def cancel_job(job):
+    """Отменяет запланированную задачу (она останется в очереди, но не будет выполнена)."""
+    if job is not None:
+        with scheduler_cv:
+            job[2] = None
+
+def set_next_job(ctx, job):
+    """Запоминает запланированную автоотправку пользователя, отменяя предыдущую."""
+    with ctx.lock:
+        old_job, ctx.next_job = ctx.next_job, job
+    cancel_job(old_job)
+
+def scheduler_worker():
+    """
+    Единственный поток, обслуживающий отложенные задачи всех пользователей (таймауты, следующие вопросы).
+    Спит до ближайшего срока и передаёт задачу в executor, не блокируясь на сетевых вызовах.
+    """
+    while True:
+        with scheduler_cv:
+            while not scheduler_heap:
+                scheduler_cv.wait()
+            when = scheduler_heap[0][0]
+            delay = when - time.time()
+            if delay > 0:
+                scheduler_cv.wait(delay)
+                continue
+            _, _, func, args = heapq.heappop(scheduler_heap)
+        if func is not None:
+            executor.submit(func, *args)
+
+def handle_timeout(user_id, start_time):
+    """Обработка ситуации истечения времени ответа."""
+    ctx = get_user(user_id)
+    with ctx.lock:
+        quiz = ctx.quiz
+        # Запись устарела, если пользователь ответил или получил новую викторину
+        if quiz is None or quiz.start_time != start_time:
             logging.info(f"Пользователь {user_id} ответил до истечения таймаута. Таймаут отменён.")
-            user_timeouts_active[user_id] = False
             return
-    if user_id in user_quiz and user_timeouts_active.get(user_id, False):
-        handle_timeout(user_id)
+        ctx.quiz = None
+        adjust_weight(ctx, quiz.kanji, 2.0)
+    # Текст правильного ответа уже подготовлен при создании викторины
+    send_message(
+        user_id,
+        FORMAT_TIMEOUT(answer=quiz.answers_text),
+        parse_mode="Markdown"
+    )
+    set_next_job(ctx, schedule(2, send_quiz_scheduled, user_id))
 
-def handle_timeout(user_id):
-    """Обработка ситуации истечения времени ответа."""
-    if user_id in user_quiz:
-        correct_answer = (user_quiz[user_id]["kanji"]
-                          if user_quiz[user_id]["type"] in ["reverse_reading", "reverse_meaning"]
-                          else user_quiz[user_id][user_quiz[user_id]["type"]])
-        bot.send_message(
-            user_id, 
-            loc["timeout_message"].format(answer=correct_answer),
-            parse_mode="Markdown"
-        )
-        del user_quiz[user_id]
-        user_timeouts_active[user_id] = False
-        time.sleep(2)
-        send_quiz_auto(user_id)
+def get_timeout(ctx):
+    """Таймаут ответа пользователя в минутах (по умолчанию 1 минута)."""
+    return ctx.timeout if ctx.timeout is not None else 1
+
+def claim_next_quiz(ctx):
+    """Атомарно отмечает, что следующий вопрос отправлен; возвращает False, если это уже сделано."""
+    with ctx.lock:
+        if ctx.next_quiz_sent:
+            return False
+        ctx.next_quiz_sent = True
+        return True
 
-def wait_and_send_next(user_id, delay):
+def send_next_quiz(user_id):
     """
-    Ожидает заданное время (delay) после правильного ответа и, если пользователь не нажал кнопку «Следующий»,
+    Вызывается по истечении времени после правильного ответа: если пользователь не нажал кнопку «Следующий»,
     отправляет следующий вопрос.
+    Автоотправка и тихий режим проверяются до claim_next_quiz: пропущенная отправка не должна
+    расходовать кнопку «Следующий».
     """
-    time.sleep(delay)
-    if not user_next_quiz_sent.get(user_id, False):
-        user_next_quiz_sent[user_id] = True
-        send_quiz_auto(user_id)
+    ctx = get_user(user_id)
+    if not ctx.quiz_active:
+        return
+    quiet_left = quiet_seconds_left(ctx)
+    if quiet_left > 0:
+        set_next_job(ctx, schedule(quiet_left, send_next_quiz, user_id))
+        return
+    if claim_next_quiz(ctx):
+        send_quiz_scheduled(user_id)
+
+def quiet_seconds_left(ctx):
+    """
+    Сколько секунд осталось до конца тихого режима пользователя (0, если сейчас он не действует).
+    Интервал может переходить через полночь.
+    """
+    if not ctx.quiet:
+        return 0
+    start, end = ctx.quiet
+    tm = time.localtime()
+    now = tm.tm_hour * 60 + tm.tm_min
+    if start <= end:
+        quiet = start <= now < end
+    else:
+        quiet = now >= start or now < end
+    if not quiet:
+        return 0
+    return ((end - now) % 1440) * 60 - tm.tm_sec
+
+def send_quiz_scheduled(user_id):
+    """
+    Автоматическая отправка викторины из очереди задач.
+    Пропускается, если автоотправка отключена или уже есть активная викторина;
+    в тихий режим откладывается сразу до его окончания.
+    """
+    ctx = get_user(user_id)
+    if not ctx.quiz_active or ctx.quiz is not None:
+        return
+    quiet_left = quiet_seconds_left(ctx)
+    if quiet_left > 0:
+        set_next_job(ctx, schedule(quiet_left, send_quiz_scheduled, user_id))
+        return
+    send_quiz_auto(user_id)
 
-@bot.message_handler(func=lambda message: message.chat.id in user_quiz)
 def check_answer(message):
     """
     Проверяет ответ пользователя на викторину.
@@ -354,82 +829,139 @@ def check_answer(message):
     При правильном ответе отправляет сообщение с кнопкой «Следующий».
     """
     user_id = message.chat.id
-    user_response = message.text.strip().lower()
-    if user_id not in user_quiz:
-        bot.send_message(user_id, loc["no_active_quiz"])
+    user_response = normalize_answer(message.text.strip())
+    ctx = get_user(user_id)
+    quiz_data = ctx.quiz
+    if quiz_data is None:
+        send_message(user_id, MSG_NO_ACTIVE_QUIZ)
         return
-    quiz_data = user_quiz[user_id]
-    # Определяем правильный ответ в зависимости от типа викторины
-    if quiz_data["type"] in ["reverse_reading", "reverse_meaning"]:
-        correct_answers = [quiz_data["kanji"].lower()]
-    else:
-        correct_answers = [ans.strip() for ans in quiz_data[quiz_data["type"]].lower().split(",")]
-    if user_response in correct_answers:
-        keyboard = InlineKeyboardMarkup()
-        keyboard.add(InlineKeyboardButton(loc["btn_next"], callback_data="next_question"))
-        bot.send_message(
+    if user_response in quiz_data.answers:
+        with ctx.lock:
+            # Викторина могла истечь или смениться, пока мы проверяли ответ
+            if ctx.quiz is not quiz_data:
+                return
+            ctx.quiz = None
+            ctx.next_quiz_sent = False
+            cancel_job(ctx.timeout_job)
+            adjust_weight(ctx, quiz_data.kanji, 2.0 if ctx.quiz_missed else 0.5)
+        # Следующий вопрос планируем до ответа пользователю: срок отсчитывается от начала викторины,
+        # но не раньше чем через секунду, чтобы сообщение «Верно!» пришло первым
+        deadline = quiz_data.start_time + get_timeout(ctx) * 60
+        set_next_job(ctx, schedule_at(max(deadline, time.time() + 1), send_next_quiz, user_id))
+        send_message(
             user_id,
-            loc["correct_answer_message"].format(answers=', '.join(correct_answers), btn_next=loc["btn_next"]),
+            FORMAT_CORRECT(answers=quiz_data.answers_text, btn_next=BTN_NEXT),
             parse_mode="Markdown",
-            reply_markup=keyboard
+            reply_markup=NEXT_KEYBOARD
         )
-        del user_quiz[user_id]
-        user_timeouts_active[user_id] = False
-        user_next_quiz_sent[user_id] = False
-        timeout_value = user_timeouts.get(user_id, 1)
-        timeout_seconds = timeout_value * 60
-        elapsed = time.time() - quiz_data["start_time"]
-        delay = timeout_seconds - elapsed
-        if delay < 0:
-            delay = 0
-        executor.submit(wait_and_send_next, user_id, delay)
     else:
+        # Вес изменится один раз, когда викторина завершится; здесь только отмечаем ошибку
+        with ctx.lock:
+            if ctx.quiz is quiz_data:
+                ctx.quiz_missed = True
         # Вычисляем оставшееся время таймаута
-        timeout_value = user_timeouts.get(user_id, 1)
+        timeout_value = get_timeout(ctx)
         timeout_seconds = timeout_value * 60
-        elapsed = time.time() - quiz_data["start_time"]
+        elapsed = time.time() - quiz_data.start_time
         remaining = int(timeout_seconds - elapsed)
         if remaining < 0:
             remaining = 0
         minutes, seconds = divmod(remaining, 60)
         remaining_str = f"{minutes} мин {seconds} сек"
-        bot.send_message(user_id, loc["incorrect_answer_message"].format(remaining=remaining_str))
+        send_message(user_id, FORMAT_INCORRECT(remaining=remaining_str))
 
 @bot.message_handler(commands=["stopquizauto"])
 def stop_quiz_auto(message):
     """Останавливает автоотправку викторин для пользователя."""
-    user_id = message.chat.id
-    if user_quiz_active.get(user_id, True):
-        user_quiz_active[user_id] = False
-        bot.send_message(user_id, loc["stopquizauto_success"])
+    stop_quiz_auto_for(message.chat.id)
+
+def stop_quiz_auto_for(user_id):
+    """Отключает автоотправку викторин (общая логика для команды и кнопки)."""
+    ctx = get_user(user_id)
+    if ctx.quiz_active:
+        ctx.quiz_active = False
+        save_user_settings(user_id)
+        send_message(user_id, loc["stopquizauto_success"])
         logging.info(f"Автоотправка викторин отключена для {user_id}.")
     else:
-        bot.send_message(user_id, loc["stopquizauto_already"])
+        send_message(user_id, loc["stopquizauto_already"])
+
+# Обработчики ввода после выбора команды (состояние пользователя -> обработчик)
+STATE_HANDLERS = {
+    "setup": handle_setup_command,
+    "settimeout": handle_set_timeout_command,
+    "setquietinterval": handle_set_quiet_interval_command,
+}
+
+# Регистрируется последним, чтобы команды обрабатывались своими обработчиками
+@bot.message_handler(content_types=["text"])
+def route_message(message):
+    """Единая точка обработки текстовых сообщений: ввод после команды или ответ на викторину."""
+    user_id = message.chat.id
+    ctx = users.get(user_id)
+    if ctx is None:
+        return
+    with ctx.lock:
+        command, ctx.state = ctx.state, None
+    if command is not None:
+        STATE_HANDLERS[command](user_id, message)
+    elif ctx.quiz is not None:
+        check_answer(message)
 
 def show_mode_selection(user_id):
     """Показывает кнопки для выбора режима викторины, включая реверс-режимы."""
-    keyboard = InlineKeyboardMarkup(row_width=3)
-    modes = [
-        (loc["mode_reading"], "mode_reading"),
-        (loc["mode_meaning"], "mode_meaning"),
-        (loc["mode_random"], "mode_random"),
-        (loc["mode_reverse_reading"], "mode_reverse_reading"),
-        (loc["mode_reverse_meaning"], "mode_reverse_meaning")
-    ]
-    buttons = [InlineKeyboardButton(text, callback_data=callback_data) for text, callback_data in modes]
-    keyboard.add(*buttons)
-    bot.send_message(user_id, loc["mode_selection"], reply_markup=keyboard)
+    send_message(user_id, loc["mode_selection"], reply_markup=MODE_KEYBOARD)
 
 def signal_handler(sig, frame):
     """Грейсфул завершение работы при получении сигнала."""
     logging.info("Завершаю работу...")
+    flush_user_settings()
     bot.stop_polling()
     sys.exit(0)
 
+# WSGI-приложение для приёма обновлений через вебхук (gunicorn "quiz-bot:app").
+# Flask импортируется только в режиме вебхука, для long polling он не нужен.
+if WEBHOOK_HOST:
+    from flask import Flask, request, abort
+
+    app = Flask(__name__)
+
+    @app.route(WEBHOOK_PATH, methods=["POST"])
+    def webhook():
+        """Принимает обновление от Telegram и передаёт его обработчикам бота."""
+        if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            abort(403)
+        update = telebot.types.Update.de_json(request.get_data(as_text=True))
+        bot.process_new_updates([update])
+        return ""
+
+def setup_webhook():
+    """Регистрирует вебхук в Telegram."""
+    bot.remove_webhook()
+    certificate = open(WEBHOOK_SSL_CERT, "rb") if WEBHOOK_SSL_CERT else None
+    try:
+        bot.set_webhook(url=WEBHOOK_HOST + WEBHOOK_PATH, certificate=certificate, secret_token=WEBHOOK_SECRET)
+    finally:
+        if certificate:
+            certificate.close()
+    # Путь содержит секрет, поэтому в лог пишем только хост
+    logging.info(f"Вебхук установлен для {WEBHOOK_HOST}")
+
 # Регистрируем обработчики сигналов
 signal.signal(signal.SIGINT, signal_handler)
 signal.signal(signal.SIGTERM, signal_handler)
 
 # Загружаем настройки и запускаем бота
 load_user_settings()
-bot.polling(none_stop=True)
+threading.Thread(target=scheduler_worker, daemon=True).start()
+threading.Thread(target=settings_flusher, daemon=True).start()
+# Дописываем несохранённые изменения при любом завершении процесса
+atexit.register(flush_user_settings)
+if WEBHOOK_HOST:
+    setup_webhook()
+    if __name__ == "__main__":
+        ssl_context = (WEBHOOK_SSL_CERT, WEBHOOK_SSL_PRIV) if WEBHOOK_SSL_CERT else None
+        app.run(host=WEBHOOK_LISTEN, port=WEBHOOK_PORT, ssl_context=ssl_context, threaded=True)
+else:
+    # Длинный опрос: одно соединение ждёт обновлений до POLLING_TIMEOUT секунд вместо частых коротких запросов
+    bot.infinity_polling(timeout=POLLING_TIMEOUT, long_polling_timeout=POLLING_TIMEOUT)